@@ -7,6 +7,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from matplotlib.colors import ListedColormap, BoundaryNorm
+from matplotlib.cm import ScalarMappable
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 # DB management
 import h5py as h5
@@ -16,6 +18,7 @@ from logzero import logger
 
 # command-line parsing
 import sys
+import subprocess
 import argparse
 from argparse import Namespace
 
@@ -39,107 +42,179 @@ if len( sys.argv )==1: # print help message if no command line arguments
 logger.info( f'Loading simulation file {args.dump}...' )
 with h5.File( args.dump, 'r' ) as fid: 
     img_backdrop = fid[ 'image' ][:]
-    pressure_wave = fid[ 'pressure' ][:]
-    params = dict( fid[ 'pressure' ].attrs )
+    pressure_ds = fid[ 'pressure' ]
+    params = dict( pressure_ds.attrs )
     materials_dict = { key.replace( 'medium_', '' ):val for key, val in params.items() if 'medium_' in key }
     segs, orders = list( materials_dict.keys() ), list( materials_dict.values() )
     segs = [ segs[n] for n in np.argsort( orders ) ]
     orders = np.sort( orders )
-    
+
     # specific modifications to the legend
     segs = [ st if st != 'water' else 'electrolyte' for st in segs ]
     segs = [ st if st != 'oil' else 'couplant' for st in segs ]
 
     params = Namespace( **params )
     
-fs = args.skip_frame
-if args.signal: 
-    fig = plt.figure( figsize=( 14, 5 ) )
-    ax = fig.subplots( 1, 2 )
-    myax = ax[0]
-else: 
-    fig = plt.figure( figsize=( 7, 7 ) )
-    ax = fig.subplots( 1, 1 )
-    myax = ax
-
-num_categories = len( segs )
-colors = plt.get_cmap( 'tab10', num_categories ).colors  
-cmap = ListedColormap( colors )
-bounds = -0.5 + np.arange( len( segs )+1 )
-norm = BoundaryNorm( bounds, cmap.N )
-
-im = myax.pcolormesh( np.arange( params.x.size ), np.arange( params.y.size ), img_backdrop, cmap=cmap, norm=norm, alpha=0.5 )
-cbar = fig.colorbar( im, ax=myax, fraction=0.046, pad=0.05, ticks=np.arange( len( segs ) ) )
-cbar.ax.set_yticklabels( segs )
-fld = myax.imshow( pressure_wave[0,:,:], origin='lower', cmap='seismic' )
-myax.plot( params.xloc, params.yloc, '^k', markersize=2, label='Source' )
-
-fld.set_clim( [ params.pmin/params.csf, params.pmax/params.csf ] )
-myax.set_xlim( [ 0, params.x.size ] )
-myax.set_yticks( np.arange( 0, params.y.size, 100 ), [ f'{st:.2f}' for st in params.y[::100] ] )
-myax.set_xticks( np.arange( 0, params.x.size, 100 ), [ f'{st:.2f}' for st in params.x[::100] ] )
-myax.set_xlabel( 'x (mm)' )
-myax.set_ylabel( 'y (mm)' )
-myax.axis( 'equal' )
-myax.axis( 'square' )
-titl = myax.set_title( f'Pressure wave at time step {0:.3f} us', weight='bold' )
-
-if args.signal:
-    ax[1].plot( params.t/1.e-6, pressure_wave[:,params.yloc,params.xloc].sum( axis=1 ) )
-    ax[1].set_xlabel( 't ($\\mu$s)' )
-    ax[1].axis( 'tight' )
-    ax[1].grid()
-    ax[1].set_title( 'Pulse echo signal', weight='bold' )
-
-if args.focus_regime: 
-    if hasattr( params, 'focal_length' ):
-        logger.info( f'Plotting focus regime at {params.focal_length:.2f} focus...' ) 
-        edge1, edge2 = params.xloc.min(), params.xloc.max() 
-        # mid = np.argmin( np.abs( params.x ) )
-        mid = 0.5*( edge1 + edge2 )
-        if not isinstance( mid, int ):
-            mid = mid.mean()
-        foc = np.argmin( np.abs( params.y -params.y[params.yloc[0]] - params.focal_length ) )
-        pts = np.array( 
-            [ 
-                [ edge1, params.yloc[0] ], 
-                [ mid, foc ], 
-                [ edge2, params.yloc[0] ]
-            ]
-        ).T
-        myax.plot( pts[0,:], pts[1,:], color=[0.5]*3, linestyle=':', label='Focus regime' )
+    fs = args.skip_frame
+    if args.signal: 
+        fig = plt.figure( figsize=( 14, 5 ) )
+        ax = fig.subplots( 1, 2 )
+        myax = ax[0]
     else: 
-        logger.warning( 'No focal length specified. Skipping focus regime... ' )
-
-myax.legend( loc=args.legend_loc )
-plt.tight_layout()
-
-if args.animate: 
-    def animate( n ):
-        fld.set_data( pressure_wave[fs*n,:,:] )
-        fld.set_clim( [ params.pmin/params.csf, params.pmax/params.csf ] )
-        titl.set_text( f'Pressure wave at time {(fs*n*params.dt/1.e-6):.3f} us' )
-        return fld,
-
-    ani = animation.FuncAnimation( 
-        fig, 
-        animate, 
-        interval=10, 
-        frames=pressure_wave[::fs,:,:].shape[0], 
-        # frames=10,
-        blit=False, 
-        repeat=False 
-    )
-    plt.show()
-
-    if args.movie is not None: 
-        assert isinstance( args.movie, str ), 'Should provide a string for movie file name. '
-        assert args.movie[-4:]=='.mp4', 'Movie file should contain extention .mp4 '
-        logger.info( f'Writing animation to {args.movie}...' )
-        writervideo = animation.FFMpegWriter( fps=60 ) 
-        ani.save(f'{args.movie}', writer=writervideo ) 
+        fig = plt.figure( figsize=( 7, 7 ) )
+        ax = fig.subplots( 1, 1 )
+        myax = ax
+
+    num_categories = len( segs )
+    colors = plt.get_cmap( 'tab10', num_categories ).colors  
+    cmap = ListedColormap( colors )
+    bounds = -0.5 + np.arange( len( segs )+1 )
+    norm = BoundaryNorm( bounds, cmap.N )
+
+    # segmentation backdrop, kept above the pressure field
+    rgba = cmap( norm( img_backdrop ) )
+    bkg = myax.imshow( rgba, origin='lower', interpolation='nearest', alpha=0.5, zorder=1 )
+    cbar = fig.colorbar( ScalarMappable( norm=norm, cmap=cmap ), ax=myax, fraction=0.046, pad=0.05, ticks=np.arange( len( segs ) ), alpha=0.5 )
+    cbar.ax.set_yticklabels( segs )
+    # fixed color limits
+    vmin, vmax = params.pmin/params.csf, params.pmax/params.csf
+    # frames read as float32
+    frames_f32 = pressure_ds.astype( np.float32 )
+    fld = myax.imshow( frames_f32[0], origin='lower', cmap='seismic', vmin=vmin, vmax=vmax )
+    myax.plot( params.xloc, params.yloc, '^k', markersize=2, label='Source' )
+
+    myax.set_xlim( [ -0.5, params.x.size-0.5 ] )
+    myax.set_ylim( [ -0.5, params.y.size-0.5 ] )
+    myax.set_yticks( np.arange( 0, params.y.size, 100 ), np.char.mod( '%.2f', params.y[::100] ) )
+    myax.set_xticks( np.arange( 0, params.x.size, 100 ), np.char.mod( '%.2f', params.x[::100] ) )
+    myax.set_xlabel( 'x (mm)' )
+    myax.set_ylabel( 'y (mm)' )
+    myax.set_aspect( 'equal', adjustable='box' )
+    myax.set_title( f'Pressure wave at time step {0:.3f} us', weight='bold' )
+
+    if args.signal:
+        # slab reads from HDF5, then gather in NumPy
+        yloc, xloc = np.asarray( params.yloc ), np.asarray( params.xloc )
+        ymin, ymax = yloc.min(), yloc.max()
+        xmin, xmax = xloc.min(), xloc.max()
+        rows = np.unique( yloc )
+        row_span = sum( np.ptp( xloc[yloc==y] )+1 for y in rows )
+        if ( ymax-ymin+1 )*( xmax-xmin+1 ) <= 4*row_span: # elements fill their bounding box well enough, read it in one go
+            block = pressure_ds[ :, ymin:ymax+1, xmin:xmax+1 ]
+            sig = block[ :, yloc-ymin, xloc-xmin ].sum( axis=1 )
+        else: # sparse layout, read one contiguous slab per row of elements
+            sig = np.zeros( pressure_ds.shape[0] )
+            for y in rows: 
+                xs = xloc[yloc==y]
+                slab = pressure_ds[ :, y, xs.min():xs.max()+1 ]
+                sig += slab[ :, xs-xs.min() ].sum( axis=1 )
+        ax[1].plot( params.t/1.e-6, sig )
+        ax[1].set_xlabel( 't ($\\mu$s)' )
+        ax[1].axis( 'tight' )
+        ax[1].grid()
+        ax[1].set_title( 'Pulse echo signal', weight='bold' )
+
+    if args.focus_regime: 
+        if hasattr( params, 'focal_length' ):
+            logger.info( f'Plotting focus regime at {params.focal_length:.2f} focus...' ) 
+            edge1, edge2 = params.xloc.min(), params.xloc.max() 
+            # mid = np.argmin( np.abs( params.x ) )
+            mid = 0.5*( edge1 + edge2 )
+            if not isinstance( mid, int ):
+                mid = mid.mean()
+            foc = np.argmin( np.abs( params.y -params.y[params.yloc[0]] - params.focal_length ) )
+            pts = np.array( 
+                [ 
+                    [ edge1, params.yloc[0] ], 
+                    [ mid, foc ], 
+                    [ edge2, params.yloc[0] ]
+                ]
+            ).T
+            myax.plot( pts[0,:], pts[1,:], color=[0.5]*3, linestyle=':', label='Focus regime' )
+        else: 
+            logger.warning( 'No focal length specified. Skipping focus regime... ' )
+
+    myax.legend( loc=args.legend_loc )
+    plt.tight_layout()
+
+    if args.animate: 
+        # time stamp sits inside the axes so that blitting (which only refreshes the axes bbox) redraws it
+        myax.set_title( 'Pressure wave', weight='bold' )
+        titl = myax.text( 0.02, 0.98, f'Time {0:.3f} us', transform=myax.transAxes, va='top', weight='bold' )
+
+        # everything layered above the pressure field is redrawn with it, else blitting would paint over it
+        blitted = [ fld, bkg, *myax.lines, myax.get_legend(), titl ]
+        for artist in blitted: 
+            artist.set_animated( True )
+        num_frames = ( pressure_ds.shape[0] + fs - 1 )//fs # ceil division, no data read
+
+        def animate( n ):
+            fld.set_data( frames_f32[fs*n] )
+            titl.set_text( f'Time {(fs*n*params.dt/1.e-6):.3f} us' )
+            return blitted
+
+        ani = animation.FuncAnimation( 
+            fig, 
+            animate, 
+            interval=10, 
+            frames=num_frames, 
+            # frames=10,
+            blit=True, 
+            repeat=False 
+        )
+        plt.show()
+
+        if args.movie is not None: 
+            assert isinstance( args.movie, str ), 'Should provide a string for movie file name. '
+            assert args.movie[-4:]=='.mp4', 'Movie file should contain extention .mp4 '
+            logger.info( f'Writing animation to {args.movie}...' )
+            # pipe raw RGBA canvas buffers straight to ffmpeg; no per-frame PNG round trip through matplotlib
+            for artist in blitted: # regular canvas draws skip animated artists
+                artist.set_animated( False )
+            # render on our own Agg canvas, like savefig does, rather than on the closed GUI window's canvas
+            canvas = FigureCanvasAgg( fig )
+            canvas.draw()
+            width, height = canvas.get_width_height( physical=True )
+            ffmpeg = plt.rcParams[ 'animation.ffmpeg_path' ]
+
+            # GPU-encode with NVENC if ffmpeg has it and a CUDA device accepts a test frame, else CPU x264
+            probe = subprocess.run( 
+                [ ffmpeg, '-loglevel', 'error', '-f', 'lavfi', '-i', 'nullsrc=s=256x256', '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-' ], 
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL 
+            )
+            if probe.returncode==0: 
+                logger.info( 'Encoding with h264_nvenc...' )
+                codec = [ '-c:v', 'h264_nvenc', '-preset', 'p1', '-rc', 'constqp', '-qp', '1' ]
+            else: 
+                logger.info( 'NVENC unavailable, encoding with libx264...' )
+                codec = [ '-c:v', 'libx264', '-preset', 'ultrafast' ]
+
+            cmd = [ 
+                ffmpeg, '-y', '-loglevel', 'error', 
+                '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f'{width}x{height}', '-r', '60', '-i', '-', 
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', # yuv420p needs even frame dimensions
+                *codec, '-pix_fmt', 'yuv420p', 
+                args.movie
+            ]
+            proc = subprocess.Popen( cmd, stdin=subprocess.PIPE, bufsize=1<<20 )
+            try: 
+                for n in range( num_frames ): 
+                    animate( n )
+                    canvas.draw()
+                    proc.stdin.write( canvas.buffer_rgba() )
+            except BrokenPipeError: 
+                pass # ffmpeg exited early; reported through its return code below
+            finally: 
+                try: 
+                    proc.stdin.close()
+                except BrokenPipeError: 
+                    pass
+                returncode = proc.wait()
+            if returncode != 0: 
+                raise RuntimeError( f'ffmpeg exited with status {returncode} while writing {args.movie}. ' )
+        else: 
+            logger.info( 'Skipping movie dump...' )
     else: 
-        logger.info( 'Skipping movie dump...' )
-else: 
-    logger.info( 'Skipping animation...' )
-    plt.show()
+        logger.info( 'Skipping animation...' )
+        fid.close() # nothing left to read, release the file before blocking on the window
+        plt.show()
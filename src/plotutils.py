@@ -12,6 +12,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 from matplotlib.colors import ListedColormap, BoundaryNorm
+from matplotlib.cm import ScalarMappable
+from matplotlib.collections import LineCollection
 
 
 def PlotGraduatedData(
@@ -57,8 +59,9 @@ def PlotGraduatedData(
     if default_ax is None:
         default_ax = plt.figure(figsize=figsize).subplots()
 
-    for n, y in enumerate(ylist_ordered):
-        default_ax.plot(x, y, color=colors[n])
+    segments = [np.column_stack([x, y]) for y in ylist_ordered]
+    default_ax.add_collection(LineCollection(segments, colors=colors))
+    default_ax.autoscale_view()
     default_ax.grid()
     ax_ins = inset_axes(default_ax, width='30%', height='7%', loc=loc)
     scaled_index = np.linspace(value_range[0], value_range[1], 100)
@@ -126,11 +129,17 @@ def PlotLabeledSegmentsImage(
     if default_ax is None:
         default_ax = plt.figure(figsize=figsize).subplots()
 
-    im = default_ax.pcolormesh(
-        x_grid, y_grid, img, cmap=cmap, norm=norm, alpha=alpha
+    # Cells centred on the grid points; zorder 1 keeps the backdrop above field images.
+    dx = (x_grid[-1] - x_grid[0]) / max(len(x_grid) - 1, 1)
+    dy = (y_grid[-1] - y_grid[0]) / max(len(y_grid) - 1, 1)
+    extent = [x_grid[0] - dx / 2, x_grid[-1] + dx / 2, y_grid[0] - dy / 2, y_grid[-1] + dy / 2]
+    default_ax.imshow(
+        cmap(norm(img)), origin='lower', extent=extent, interpolation='nearest',
+        aspect=default_ax.get_aspect(), alpha=alpha, zorder=1
     )
     cbar = plt.colorbar(
-        im, ax=default_ax, fraction=0.046, pad=0.05, ticks=np.arange(len(segments))
+        ScalarMappable(norm=norm, cmap=cmap), ax=default_ax, fraction=0.046, pad=0.05,
+        ticks=np.arange(len(segments)), alpha=alpha
     )
     cbar.ax.set_yticklabels(segments)
     return default_ax
@@ -11,19 +11,50 @@
 
 import numpy as np
 from logzero import logger
-from tqdm.contrib.concurrent import process_map
+
+try: 
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError: 
+    logger.debug( 'numba not found; falling back to NumPy ray-tracing. ' )
+    HAS_NUMBA = False
 
 def SampleAlongLine( origin, direction, step_size, num_steps ):
-    direction /= np.linalg.norm( direction ) # normalize to get unit vector
-    locations = [ 
-        origin + n*step_size*direction
-        for n in range( num_steps )
-    ]
-    locations = np.concatenate( [ ar[:,np.newaxis] for ar in locations ], axis=1 )
-    return locations
+    """
+    Returns num_steps equispaced points along a line as a ( D, num_steps ) array.
+    The input direction is normalized into a local copy and is not modified.
+    """
+    origin = np.asarray( origin, dtype=np.float64 )
+    d = np.asarray( direction, dtype=np.float64 )
+    delta = step_size * d / np.linalg.norm( d )
+    t = np.arange( num_steps, dtype=np.float64 )
+    return origin[:,np.newaxis] + delta[:,np.newaxis] * t[np.newaxis,:]
+
+def IsInMapRegionBatch( points, map_lims ):
+    # points is ( N, D ), map_lims is ( D, 2 ) of [ lower, upper ] bounds per axis
+    points = np.atleast_2d( points )
+    map_lims = np.asarray( map_lims )
+    return ( ( points >= map_lims[:,0] ) & ( points <= map_lims[:,1] ) ).all( axis=1 )
 
 def IsInMapRegion( point, map_lims ):
-    return all( [ pt >= ml[0] and pt <= ml[1] for pt, ml in zip( point, map_lims ) ] )
+    return bool( IsInMapRegionBatch( point, map_lims )[0] )
+
+if HAS_NUMBA: 
+    @njit( cache=True, boundscheck=True ) # no fastmath, FMA contraction would shift samples
+    def _tof( origin, direction, distance, num_steps, speed_map ):
+        # walks each 2D ray with the same samples as CalculateTimeOfFlight, accumulating travel time in a scalar
+        times = np.empty( distance.size )
+        for r in range( distance.size ): 
+            n = num_steps[r]
+            step = distance[r] / max( n-1, 1 )
+            acc = 0.
+            for k in range( n ): 
+                s = distance[r] if ( k==n-1 and n>1 ) else k*step
+                i0 = int( np.rint( s*direction[r,0] + origin[0] ) )
+                i1 = int( np.rint( s*direction[r,1] + origin[1] ) )
+                acc += 1. / speed_map[i0,i1]
+            times[r] = step * acc
+        return times
 
 def CalculateTimeOfFlight( point_query, point_origin, speed_map, steps_per_pixel=8 ):
     assert point_query.size == point_origin.size == np.ndim( speed_map ), 'Point dimension mismatch. '
@@ -32,13 +63,49 @@ def CalculateTimeOfFlight( point_query, point_origin, speed_map, steps_per_pixel
     displacement = point_query - point_origin
     distance = np.linalg.norm( displacement )
     direction = displacement / distance 
-    steps = np.linspace( 0., distance, np.round( distance*steps_per_pixel ).astype( int ) )
-    dx = ( steps[1:] - steps[:-1] ).mean()
+    steps = np.linspace( 0., distance, int( distance*steps_per_pixel + 0.5 ) )
+    dx = distance / max( steps.size - 1, 1 ) # one step for single-sample rays
     samples = steps[np.newaxis,:] * direction[:,np.newaxis] 
-    samples += point_origin[:,np.newaxis].repeat( samples.shape[1], axis=1 )
-    samples = np.round( samples ).astype( int )
-    speeds = speed_map[ *samples ]
-    dt = np.array( [ dx / sp for sp in speeds ] )
-    return dt.sum(), speeds
+    samples += point_origin[:,np.newaxis]
+    np.rint( samples, out=samples )
+    samples_i = samples.astype( np.int32, copy=False )
+    speeds = speed_map[ tuple( samples_i ) ]
+    inv = np.reciprocal( speeds, dtype=np.float64 )
+    return dx * inv.sum(), speeds
+
+def CalculateTimeOfFlightBatch( query_points, origin, speed_map, steps_per_pixel=8 ):
+    # query_points is ( R, D ), one ray per row, all rays sharing the same origin
+    query_points = np.atleast_2d( query_points ).astype( np.float64 )
+    origin = np.asarray( origin, dtype=np.float64 )
+    assert query_points.shape[1] == origin.size == np.ndim( speed_map ), 'Point dimension mismatch. '
+    assert isinstance( speed_map, np.ndarray ) and speed_map.flags.c_contiguous, 'speed_map should be a C-contiguous array; convert it once with np.ascontiguousarray. '
+
+    # assuming input points are already in pixel units
+    displacement = query_points - origin[np.newaxis,:]
+    distance = np.linalg.norm( displacement, axis=1 )
+    direction = np.divide( displacement, distance[:,np.newaxis], out=np.zeros_like( displacement ), where=distance[:,np.newaxis]>0 )
+    num_steps = ( distance*steps_per_pixel + 0.5 ).astype( int )
+    div = np.maximum( num_steps-1, 1 )
+    if HAS_NUMBA and origin.size==2: 
+        return _tof( origin, direction, distance, num_steps, speed_map )
+    n_max = num_steps.max()
 
+    # reproduces np.linspace( 0., distance, num_steps ) per ray (k*step, last sample pinned to distance),
+    # padded to the longest ray; padding is clamped to the ray end so it stays on the map, then masked out
+    k = np.arange( n_max )
+    mask = k[np.newaxis,:] < num_steps[:,np.newaxis]
+    steps = np.minimum( k[np.newaxis,:] * ( distance/div )[:,np.newaxis], distance[:,np.newaxis] )
+    pinned = ( k[np.newaxis,:] >= ( num_steps-1 )[:,np.newaxis] ) & ( num_steps[:,np.newaxis] > 1 )
+    steps = np.where( pinned, distance[:,np.newaxis], steps )
 
+    # one contiguous int32 index array per axis (SoA) rather than a stacked ( D, R, N ) float array
+    pos = np.empty( steps.shape )
+    indices = []
+    for d in range( origin.size ): 
+        np.multiply( steps, direction[:,d,np.newaxis], out=pos )
+        pos += origin[d]
+        np.rint( pos, out=pos )
+        indices.append( pos.astype( np.int32 ) )
+    speeds = speed_map[ tuple( indices ) ]
+    dx = distance / div
+    return dx * np.where( mask, np.reciprocal( speeds, dtype=np.float64 ), 0. ).sum( axis=1 )